@@ -0,0 +1,126 @@
+import json
+import pathlib
+import sqlite3
+import threading
+from collections.abc import Iterable
+from typing import Any
+
+from loopbuilder.typing import StrPath
+
+
+DEFAULT_CACHE_FILE = pathlib.Path.home() / ".cache" / "loopbuilder" / "scores.db"
+
+# NOTE: Stay below SQLite's limit for the number of variables in a statement
+_MAX_VARIABLES = 500
+
+
+class ScoreCache:
+    """Scores stored in an SQLite database
+
+    The database connection is opened on first use and kept open. It is not pickled
+    (e.g. when sending a scorer to worker processes) but reopened on demand.
+    """
+
+    def __init__(self, cache_file: StrPath | None = None):
+        """Initialize the cache
+
+        Args:
+            cache_file: Path to the SQLite cache database. If `None`, uses `DEFAULT_CACHE_FILE`.
+        """
+
+        self.cache_file = cache_file
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {"cache_file": self.cache_file}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(state["cache_file"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is not None:
+            return self._connection
+
+        cache_file = pathlib.Path(DEFAULT_CACHE_FILE if self.cache_file is None else self.cache_file)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # NOTE: The database may be accessed by multiple worker processes at the same time.
+        #    Within a process, access from different threads is serialized by the lock.
+        connection = sqlite3.connect(str(cache_file), timeout=60, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, scores TEXT NOT NULL)")
+        self._connection = connection
+        return connection
+
+    def fetch_many(self, keys: Iterable[str]) -> dict[str, dict[str, Any]]:
+        """Fetch cached scores for multiple keys
+
+        Args:
+            keys: Cache keys
+
+        Returns:
+            Dictionary mapping keys found in the cache to their scores
+        """
+
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(keys), _MAX_VARIABLES):
+                chunk = keys[i:i + _MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = connection.execute(f"SELECT key, scores FROM scores WHERE key IN ({placeholders})", chunk)
+                found.update((key, json.loads(scores)) for key, scores in rows)
+        return found
+
+    def fetch(self, key: str) -> dict[str, Any] | None:
+        """Fetch cached scores
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Dictionary of scores or `None` if the key is not in the cache
+        """
+
+        return self.fetch_many([key]).get(key)
+
+    def store(self, key: str, scores: dict[str, Any]) -> None:
+        """Store scores in the cache
+
+        Args:
+            key: Cache key
+            scores: Dictionary of JSON-serializable scores
+        """
+
+        value = json.dumps(scores)
+        with self._lock:
+            connection = self._connect()
+            # NOTE: Commits on success, rolls back on error
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO scores (key, scores) VALUES (?, ?)", (key, value))
+
+    def close(self) -> None:
+        """Close the database connection (it is reopened on demand)"""
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def get_score_cache(score_cache: ScoreCache | None, cache_file: StrPath | None) -> ScoreCache:
+    """Reuse a (lazily created) score cache if it is for the given cache file
+
+    Args:
+        score_cache: Previously used score cache or `None`
+        cache_file: Path to the SQLite cache database. If `None`, uses `DEFAULT_CACHE_FILE`.
+
+    Returns:
+        `score_cache` if it uses `cache_file`, otherwise a new score cache
+    """
+
+    if score_cache is None or score_cache.cache_file != cache_file:
+        score_cache = ScoreCache(cache_file)
+    return score_cache
@@ -0,0 +1,41 @@
+import os
+
+from loopbuilder.typing import StrPath
+
+
+def _fadvise(path: StrPath, *advice: int) -> None:
+    """Pass advice on the access pattern of a whole file to the OS (best effort)"""
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        # NOTE: Advice values are not flags and can not be combined
+        for value in advice:
+            os.posix_fadvise(fd, 0, 0, value)
+    finally:
+        os.close(fd)
+
+
+def drop_page_cache(path: StrPath) -> None:
+    """Advise the OS that a file will not be accessed again soon
+
+    Frees the page cache used by throwaway files (e.g. rejected trial models).
+    Does nothing on platforms without `os.posix_fadvise` or if the file can not be opened.
+    """
+
+    if hasattr(os, "posix_fadvise"):
+        _fadvise(path, os.POSIX_FADV_DONTNEED)
+
+
+def prefetch(path: StrPath) -> None:
+    """Advise the OS that a file will be read sequentially soon
+
+    Starts reading the file into the page cache in the background.
+    Does nothing on platforms without `os.posix_fadvise` or if the file can not be opened.
+    """
+
+    if hasattr(os, "posix_fadvise"):
+        _fadvise(path, os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_WILLNEED)
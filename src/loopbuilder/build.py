@@ -1,20 +1,50 @@
+import copy
+import functools
+import hashlib
+import io
+import itertools
+import operator
 import os
 import pathlib
 import tempfile
 from abc import ABC, abstractmethod
-from typing import Callable
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import closing, nullcontext
+from typing import TYPE_CHECKING, Any, Callable, TypeVar
 
-import pandas as pd
 from loguru import logger
-from openmm.app import PDBxFile
-from pdbfixer import PDBFixer
-from tqdm.auto import tqdm
 
+from loopbuilder._io import drop_page_cache
 from loopbuilder.convert import extract_segment_from_mmcif, join_segments
 from loopbuilder.segment import Segment, SegmentModel
-from loopbuilder.score import Scorer, Filter
+from loopbuilder.score import CachedScorer, Scorer, Filter
 from loopbuilder.typing import StrPath
 
+if TYPE_CHECKING:
+    from pdbfixer import PDBFixer
+
+
+T = TypeVar("T")
+
+# NOTE: Columns written to the `segments.csv` and `models.csv` output files
+_SEGMENT_COLUMNS = [
+    "identifier",
+    "chain_index",
+    "chain_name",
+    "residue_start_index",
+    "residue_start_seqid",
+    "residue_index_offset",
+    "residue_names",
+    "parent_structure_file",
+]
+_MODEL_COLUMNS = [
+    "identifier",
+    "structure_file",
+    "scores",
+    "index",
+]
+
 
 class Builder(ABC):
     """Base class for loop builders
@@ -41,6 +71,12 @@ class Builder(ABC):
         scorers: list[Scorer | Callable[[SegmentModel], None]] | None = None,
         filters: list[Filter | Callable[[SegmentModel], bool]] | None = None,
         progress_bar: bool = True,
+        n_jobs: int | None = 1,
+        cache: bool = False,
+        pipeline: bool = False,
+        batch_size: int = 1,
+        parallel_scoring: bool = False,
+        trial_cache: bool = False,
     ):
         """Initialize the builder
 
@@ -54,16 +90,50 @@ class Builder(ABC):
             scorers: List of scorers to use on generated segment models
             filters: List of filters to use on generated segment models
             progress_bar: Show a progress bar for the model building process
+            n_jobs: Number of worker processes used for parallel building. If `None`, uses
+                `os.cpu_count()`. If 1, everything is done sequentially in the current process.
+                If there is more than one segment, segments are built in parallel. Otherwise,
+                trial models for the single segment are built in parallel. Builder, segments,
+                scorers, and filters need to be picklable for parallel execution.
+            cache: If `True`, wrap all `Scorer` instances in a `CachedScorer`, so that
+                scores of identical segment models are only computed once.
+            pipeline: If `True` and trial models are built sequentially, split off the segment
+                from a trial model and score it in a background thread while the next trial model
+                is already being built. This hides I/O and scoring latency (e.g. of external programs)
+                but may build one trial model per segment more than necessary.
+            batch_size: Number of trial models that are scored together (see `Scorer.score_batch`).
+                If 1, each trial model is scored right after it was built (in the worker
+                processes if trial models are built in parallel).
+            parallel_scoring: If `True`, apply the scorers concurrently in a thread pool. Only useful
+                for scorers that release the GIL (e.g. calling external programs). Scorers must not
+                interfere with each other (e.g. by writing to the same files or score keys).
+            trial_cache: If `True`, remember the scores and the filter result of each trial model
+                (in memory, by a hash of its structure). Trial models identical to a previous one
+                (PDBFixer often produces identical models) are then neither scored nor filtered
+                again but reuse the previous result. Only use this with scorers and filters that
+                return the same result for the same structure (e.g. no filters rejecting duplicates).
         """
         if working_directory is not None:
-            working_directory = pathlib.Path(working_directory).resolve()
+            working_directory = pathlib.Path(os.path.abspath(working_directory))
         self.working_directory = working_directory
-        self.structure_file = pathlib.Path(structure_file).resolve()
-        self.output_directory = pathlib.Path(output_directory).resolve()
+        # NOTE: Normalize to absolute paths without resolving symlinks, which avoids
+        #    filesystem access on initialization (e.g. slow on network mounts)
+        self.structure_file = pathlib.Path(os.path.abspath(structure_file))
+        self.output_directory = pathlib.Path(os.path.abspath(output_directory))
         self.scorers = scorers or []
+        if cache:
+            self.scorers = [CachedScorer(s) if isinstance(s, Scorer) else s for s in self.scorers]
         self.filters = filters or []
         self.segments: list[Segment] = []
         self.progress_bar = progress_bar
+        self.n_jobs = n_jobs
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.parallel_scoring = parallel_scoring
+        self.trial_cache = trial_cache
+
+        # NOTE: Scores and filter results by the hash of the segment model's structure (see `trial_cache`)
+        self._trial_cache: dict[str, tuple[dict[str, Any], bool]] = {}
 
     def find_segments(self) -> None:
         """Find missing segments in the input structure
@@ -74,24 +144,23 @@ class Builder(ABC):
         NOTE: Ignores missing terminal residues
         """
 
+        # NOTE: Imported here to avoid the (large) import cost of OpenMM if not needed
+        from pdbfixer import PDBFixer
+
         self.segments = []
         fixer = PDBFixer(filename=str(self.structure_file))
         fixer.findMissingResidues()
 
         chains = list(fixer.topology.chains())
-        non_terminal = {}
-        for key, value in fixer.missingResidues.items():
-            chain_index, missing_index = key
-            if missing_index == 0:
-                continue
-
-            if missing_index == len(chains[chain_index]):
-                continue
-
-            non_terminal[key] = value
+        residues_by_chain = [list(chain.residues()) for chain in chains]
+        non_terminal = {
+            (chain_index, missing_index): residue_names
+            for (chain_index, missing_index), residue_names in fixer.missingResidues.items()
+            if 0 < missing_index < len(residues_by_chain[chain_index])
+        }
 
         for i, ((chain_index, residue_start_index), residue_names) in enumerate(non_terminal.items(), 1):
-            chain_residues = list(chains[chain_index].residues())
+            chain_residues = residues_by_chain[chain_index]
             segment = Segment(
                 identifier=f"loop_{i}",
                 chain_index=chain_index,
@@ -155,6 +224,9 @@ class Builder(ABC):
             filter_str = ":\n" + filter_str
         logger.info(f"Using {len(self.filters)} filter(s){filter_str}")
 
+        # NOTE: Scorers and filters may have changed since the last build
+        self._trial_cache.clear()
+
         if not self.segments:
             logger.info("Looking for segments")
             self.find_segments()
@@ -165,94 +237,192 @@ class Builder(ABC):
 
         logger.info(f"Found {len(self.segments)} segments")
 
-        if self.progress_bar:
-            it_segments = tqdm(self.segments, desc="Building segments", unit="segment")
+        build_segment_models = functools.partial(
+            self._build_segment_models, n=n, max_tries=max_tries, working_directory=working_directory
+        )
+
+        if self.n_jobs == 1:
+            executor_context = nullcontext()
         else:
-            it_segments = self.segments
+            executor_context = ProcessPoolExecutor(max_workers=self.n_jobs)
 
-        for segment in it_segments:
-            logger.info(f"Building models for segment {segment.identifier}")
-            n_success = 0
-            n_tries = 0
+        with executor_context as executor:
+            if (executor is not None) and (len(self.segments) > 1):
+                # NOTE: Segments are independent of each other, so we parallelize over segments
+                #    (outer level) if there is more than one. Trials for each segment are then built
+                #    sequentially within the worker processes. This avoids nested process pools and
+                #    scales with min(n_segments, n_jobs). Trials are only built in parallel (inner level)
+                #    if there is a single segment.
+                segments = executor.map(build_segment_models, self.segments, chunksize=1)
+            else:
+                segments = (build_segment_models(segment, executor=executor) for segment in self.segments)
+
+            if self.progress_bar:
+                # NOTE: Imported here because `tqdm.auto` probes for Jupyter on import, which
+                #    worker processes re-importing this module should not pay for
+                from tqdm.auto import tqdm
+
+                segments = tqdm(segments, total=len(self.segments), desc="Building segments", unit="segment")
+
+            # NOTE: Segments built in worker processes are copies, so we need to replace the originals
+            self.segments = list(segments)
+
+        # NOTE: Imported here to avoid the import cost if `build` is not used
+        import pandas as pd
+
+        segment_df = pd.DataFrame(_columns(self.segments, _SEGMENT_COLUMNS))
+        segment_df.to_csv(self.output_directory / "segments.csv", index=False)
+
+        models = [m for segment in self.segments for m in segment.models]
+        model_df = pd.DataFrame(_columns(models, _MODEL_COLUMNS))
+        model_df.to_csv(self.output_directory / "models.csv", index=False)
+
+        return self.segments
+
+    def _build_segment_models(
+        self,
+        segment: Segment,
+        *,
+        n: int,
+        max_tries: int,
+        working_directory: pathlib.Path,
+        executor: Executor | None = None,
+    ) -> Segment:
+        """Build, score, and filter trial models for a single segment
+
+        Successful models are added to `segment.models` and joined into a single
+        output file in the output directory.
+
+        Returns:
+            The `segment` with the models built
+        """
+
+        logger.info(f"Building models for segment {segment.identifier}")
+        output_stem = f"{segment.parent_structure_file.stem}_{segment.identifier}"
+        n_success = 0
+        n_tries = 0
+
+        with closing(self._iter_trials(segment, max_tries, working_directory, executor)) as trials:
+            for batch in _batched(trials, self.batch_size):
+                if self.batch_size > 1:
+                    _score_models(self, batch)
+
+                for segment_model in batch:
+                    n_tries += 1
+                    logger.info(f"Scored trial model {n_tries} for segment {segment.identifier}: {segment_model.scores}")
+
+                    structure_hash = segment_model.structure_hash
+                    if structure_hash is not None and structure_hash in self._trial_cache:
+                        passed = self._trial_cache[structure_hash][1]
+                        logger.info(
+                            f"Trial model {n_tries} for segment {segment.identifier} is identical to a previous "
+                            f"trial model (passed={passed})"
+                        )
+                    else:
+                        passed = True
+                        for filter_ in self.filters:
+                            if not filter_(segment_model):
+                                logger.info(f"Trial model {n_tries} for segment {segment.identifier} failed filter {filter_}")
+                                passed = False
+                                break
+                        if structure_hash is not None:
+                            self._trial_cache[structure_hash] = (segment_model.scores.copy(), passed)
+
+                    if not passed:
+                        drop_page_cache(segment_model.structure_file)
+                    else:
+                        n_success += 1
+                        model_structure_file = self.output_directory / f"{output_stem}_{n_success}.cif"
+                        segment_model.structure_file.rename(model_structure_file)
+                        segment_model.structure_file = model_structure_file
+                        segment_model.index = n_success
+                        segment.models.append(segment_model)
+                        logger.success(f"Built model {n_success} for segment {segment.identifier}")
+
+                    if n_success >= n:
+                        break
 
-            while True:
                 if n_success >= n:
-                    logger.success(f"Reached the target number of models (success_rate={n_success / n_tries:.2%})")
                     break
 
-                if n_tries >= max_tries:
-                    logger.warning(f"Reached the maximum number of tries (success_rate={n_success / n_tries:.2%})")
-                    break
+        if n_success >= n:
+            logger.success(f"Reached the target number of models (success_rate={n_success / n_tries:.2%})")
+        else:
+            logger.warning(f"Reached the maximum number of tries (success_rate={n_success / n_tries:.2%})")
+
+        if segment.models:
+            model_structure_files = [m.structure_file for m in segment.models]
+            joined_model_structure_file = self.output_directory / f"{output_stem}.cif"
+            join_segments(
+                model_structure_files,
+                joined_model_structure_file,
+            )
+            for model in segment.models:
+                model.structure_file = joined_model_structure_file
+            for file in model_structure_files:
+                file.unlink(missing_ok=True)
 
-                n_tries += 1
-                segment_model = self.build_segment(segment, trial_id=str(n_tries), working_directory=working_directory)
+        return segment
 
-                segment_start = segment.residue_start_seqid
-                segment_end = segment_start + len(segment) - 1
-                model_structure_file = segment_model.structure_file.with_stem(f"{segment_model.structure_file.stem}_segment")
-                extract_segment_from_mmcif(
-                    segment_model.structure_file,
-                    model_structure_file,
-                    residue_indices={segment_start, segment_end},
-                    chain_id=segment.chain_name,
-                )
-                segment_model.structure_file = model_structure_file
+    def _iter_trials(
+        self,
+        segment: Segment,
+        max_tries: int,
+        working_directory: pathlib.Path,
+        executor: Executor | None = None,
+    ) -> Iterator[SegmentModel]:
+        """Generate up to `max_tries` scored trial models for a segment
+
+        If an `executor` is given, trials are submitted in batches of `n_jobs` and yielded
+        in order of completion. Trials that have not been started yet are cancelled
+        when the generator is closed. Otherwise, trials are built sequentially, optionally
+        pipelined (see `pipeline` in `__init__`).
+        """
+
+        trial_ids = (str(i) for i in range(1, max_tries + 1))
+
+        if (executor is None) and not self.pipeline:
+            for trial_id in trial_ids:
+                yield _run_trial(self, segment, trial_id, working_directory)
+            return
 
-                for scorer in self.scorers:
-                    scorer(segment_model)
+        if executor is None:
+            # NOTE: Post-processing of trial N overlaps with building trial N + 1
+            with ThreadPoolExecutor(max_workers=1) as io_executor:
+                future = None
+                for trial_id in trial_ids:
+                    segment_model = self.build_segment(segment, trial_id=trial_id, working_directory=working_directory)
+                    if future is not None:
+                        yield future.result()
+                    future = io_executor.submit(_process_trial, self, segment, segment_model)
+
+                if future is not None:
+                    yield future.result()
+            return
 
-                logger.info(f"Scored trial model {n_tries} for segment {segment.identifier}: {segment_model.scores}")
+        # NOTE: Filters are applied in the current process and do not need to be sent to the workers
+        worker_builder = copy.copy(self)
+        worker_builder.filters = []
+        worker_builder.segments = []
 
-                for filter_ in self.filters:
-                    if not filter_(segment_model):
-                        logger.info(f"Trial model {n_tries} for segment {segment.identifier} failed filter {filter_}")
+        n_workers = self.n_jobs or os.cpu_count() or 1
+        pending = set()
+        try:
+            while True:
+                for trial_id in trial_ids:
+                    pending.add(executor.submit(_run_trial, worker_builder, segment, trial_id, working_directory))
+                    if len(pending) >= n_workers:
                         break
-                else:
-                    n_success += 1
-                    model_structure_file = (
-                        self.output_directory / f"{segment.parent_structure_file.stem}_{segment.identifier}_{n_success}.cif"
-                    )
-                    segment_model.structure_file.rename(model_structure_file)
-                    segment_model.structure_file = model_structure_file
-                    segment_model.index = n_success
-                    segment.models.append(segment_model)
-                    logger.success(f"Built model {n_success} for segment {segment.identifier}")
-
-            if segment.models:
-                model_structure_files = [m.structure_file for m in segment.models]
-                joined_model_structure_file = self.output_directory / f"{segment.parent_structure_file.stem}_{segment.identifier}.cif"
-                join_segments(
-                    model_structure_files,
-                    joined_model_structure_file,
-                )
-                for model in segment.models:
-                    model.structure_file = joined_model_structure_file
-                for file in model_structure_files:
-                    file.unlink(missing_ok=True)
-
-
-        segment_df = pd.DataFrame(
-            self.segments,
-            columns=[
-                "identifier",
-                "chain_index",
-                "chain_name",
-                "residue_start_index",
-                "residue_start_seqid",
-                "residue_index_offset",
-                "residue_names",
-                "parent_structure_file",
-            ],
-        )
-        segment_df.to_csv(self.output_directory / "segments.csv", index=False)
 
-        models = [m for segment in self.segments for m in segment.models]
-        model_df = pd.DataFrame(
-            models,
-        )
-        model_df.to_csv(self.output_directory / "models.csv", index=False)
+                if not pending:
+                    return
 
-        return self.segments
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
 
     @abstractmethod
     def build_segment(self, segment: Segment, trial_id: str, working_directory: pathlib.Path) -> SegmentModel:
@@ -265,10 +435,119 @@ class Builder(ABC):
                 will be saved here.
 
         Returns:
-            A `SegmentModel` object
+            A `SegmentModel` object for the full structure. The segment will be split off later.
+            The structure can either be written to the model's `structure_file` or be kept in
+            memory as the model's `structure_data`, in which case `structure_file` is only used
+            to derive the filename of the segment.
         """
 
 
+def _run_trial(builder: Builder, segment: Segment, trial_id: str, working_directory: pathlib.Path) -> SegmentModel:
+    """Build a single trial model for a segment, split off the segment, and score it
+
+    Defined at module level so that it can be submitted to a process pool.
+    """
+
+    segment_model = builder.build_segment(segment, trial_id=trial_id, working_directory=working_directory)
+    return _process_trial(builder, segment, segment_model)
+
+
+def _process_trial(builder: Builder, segment: Segment, segment_model: SegmentModel) -> SegmentModel:
+    """Split off the segment from a trial model and score it (unless scoring is done in batches)"""
+
+    segment_start = segment.residue_start_seqid
+    segment_end = segment_start + len(segment) - 1
+    model_structure_file = segment_model.structure_file.with_stem(f"{segment_model.structure_file.stem}_segment")
+    extract_segment_from_mmcif(
+        segment_model.structure_file if segment_model.structure_data is None else segment_model.structure_data,
+        model_structure_file,
+        residue_indices={segment_start, segment_end},
+        chain_id=segment.chain_name,
+    )
+    if segment_model.structure_data is None:
+        # NOTE: The full structure file is not needed anymore
+        drop_page_cache(segment_model.structure_file)
+    segment_model.structure_file = model_structure_file
+    segment_model.structure_data = None
+    if builder.trial_cache:
+        segment_model.structure_hash = _hash_structure_file(model_structure_file)
+
+    if builder.batch_size == 1:
+        _score_models(builder, [segment_model])
+
+    return segment_model
+
+
+def _score_models(builder: Builder, models: list[SegmentModel]) -> None:
+    """Score a batch of models with all scorers of a builder
+
+    Models that are identical to previously filtered trial models reuse their scores (see `trial_cache`).
+    """
+
+    unscored_models = []
+    for model in models:
+        cached = None if model.structure_hash is None else builder._trial_cache.get(model.structure_hash)
+        if cached is None:
+            unscored_models.append(model)
+        else:
+            model.scores.update(cached[0])
+
+    if not unscored_models:
+        return
+
+    def apply_scorer(scorer: Scorer | Callable[[SegmentModel], None]) -> None:
+        if isinstance(scorer, Scorer):
+            scorer.score_batch(unscored_models)
+        else:
+            for model in unscored_models:
+                scorer(model)
+
+    if builder.parallel_scoring and len(builder.scorers) > 1:
+        with ThreadPoolExecutor(max_workers=len(builder.scorers)) as executor:
+            # NOTE: Consume the results to re-raise exceptions from the scorers
+            list(executor.map(apply_scorer, builder.scorers))
+    else:
+        for scorer in builder.scorers:
+            apply_scorer(scorer)
+
+
+def _hash_structure_file(structure_file: pathlib.Path) -> str:
+    """Hash the content of a structure file"""
+
+    with open(structure_file, "rb") as fp:
+        return hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+
+
+def _columns(items: list[Any], names: list[str]) -> dict[str, list[Any]]:
+    """Collect attributes of items column-wise (e.g. to construct a `DataFrame`)"""
+
+    # NOTE: Column-wise construction is much faster than passing a list of dataclasses,
+    #    which pandas converts row by row (with deep copies) via `dataclasses.asdict`
+    getters = [operator.attrgetter(name) for name in names]
+    return {name: [getter(item) for item in items] for name, getter in zip(names, getters)}
+
+
+def _batched(iterable: Iterable[T], n: int) -> Iterator[list[T]]:
+    """Collect items into lists of length `n` (the last one may be shorter)"""
+
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+@functools.lru_cache(maxsize=4)
+def _load_pdbfixer(structure_file: str, mtime_ns: int) -> "PDBFixer":
+    """Load a structure file into a (cached) `PDBFixer` instance
+
+    The modification time is part of the cache key so that changed files are reloaded.
+    Returned instances must not be modified.
+    """
+
+    from pdbfixer import PDBFixer
+
+    return PDBFixer(structure_file)
+
+
 class PDBFixerBuilder(Builder):
     def build_segment(self, segment: Segment, trial_id: str, working_directory: pathlib.Path) -> SegmentModel:
         """Build a segment model using PDBFixer
@@ -283,7 +562,11 @@ class PDBFixerBuilder(Builder):
             A `SegmentModel` object
         """
 
-        fixer = PDBFixer(str(segment.parent_structure_file))
+        from openmm.app import PDBxFile
+
+        # NOTE: The parent structure is only parsed once and copied for each trial
+        parent_structure_file = str(segment.parent_structure_file)
+        fixer = copy.deepcopy(_load_pdbfixer(parent_structure_file, os.stat(parent_structure_file).st_mtime_ns))
         fixer.missingResidues = {(segment.chain_index, segment.residue_start_index): segment.residue_names}
 
         fixer.findMissingAtoms()
@@ -292,8 +575,13 @@ class PDBFixerBuilder(Builder):
         model_structure_file = (
             working_directory / f"{segment.parent_structure_file.stem}_{segment.identifier}_{trial_id}.cif"
         )
-        with open(model_structure_file, "w") as fp:
-            # NOTE: Write out full structure here for scoring. Segments will be split off later.
-            PDBxFile.writeFile(fixer.topology, fixer.positions, file=fp, keepIds=True)
-
-        return SegmentModel(identifier=segment.identifier, structure_file=model_structure_file, scores={})
+        # NOTE: Keep the full structure in memory. Only the segment will be written to disk later.
+        buffer = io.StringIO()
+        PDBxFile.writeFile(fixer.topology, fixer.positions, file=buffer, keepIds=True)
+
+        return SegmentModel(
+            identifier=segment.identifier,
+            structure_file=model_structure_file,
+            scores={},
+            structure_data=buffer.getvalue().encode(),
+        )
@@ -1,12 +1,21 @@
+import mmap
+import os
+import re
+import shutil
 from collections.abc import Sequence
+from typing import BinaryIO
 
 import gemmi
+import numpy as np
 
 from loopbuilder.typing import StrPath
 
 
+IO_BUFFER_SIZE = 1 << 20
+
+
 def extract_segment_from_mmcif(
-    input_file: StrPath,
+    input_file: StrPath | bytes,
     output_file: StrPath,
     *,
     residue_indices: set[int],
@@ -14,8 +23,14 @@ def extract_segment_from_mmcif(
 ) -> None:
     """Extract a subset of consecutive residue entries from one into another CIF file
 
+    NOTE: If possible, the kept `_atom_site` rows are located with a single scan over
+        the memory-mapped input file and copied to the output file as they are, together
+        with everything before and after the `_atom_site` loop. This avoids parsing and
+        re-serializing the whole document. Falls back to `gemmi` if the input can not be
+        handled this way (e.g. because of multi-line or quoted values in the `_atom_site` loop).
+
     Args:
-        input_file: Path to the input CIF file
+        input_file: Path to the input CIF file or the content of a CIF file as `bytes`
         output_file: Path to the output CIF file
 
     Keyword args:
@@ -24,26 +39,157 @@ def extract_segment_from_mmcif(
         chain_id: Chain ID to filter residues from
     """
 
-    doc = gemmi.cif.read(str(input_file))
+    if isinstance(input_file, bytes):
+        if _write_segment_rows(input_file, output_file, residue_indices=residue_indices, chain_id=chain_id):
+            return
+        doc = gemmi.cif.read_string(input_file.decode())
+    else:
+        with open(str(input_file), "rb") as fpi:
+            try:
+                data = mmap.mmap(fpi.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # NOTE: Empty files can not be mapped
+                data = None
+
+        if data is not None:
+            with data:
+                if _write_segment_rows(data, output_file, residue_indices=residue_indices, chain_id=chain_id):
+                    return
+        doc = gemmi.cif.read(str(input_file))
+
+    _extract_segment_from_cif_document(doc, residue_indices=residue_indices, chain_id=chain_id)
+    doc.write_file(str(output_file))
+
+
+def _write_segment_rows(
+    data: bytes | mmap.mmap,
+    output_file: StrPath,
+    *,
+    residue_indices: set[int],
+    chain_id: str,
+) -> bool:
+    """Write the raw bytes of a CIF file to another file, keeping only the kept `_atom_site` rows
+
+    Returns:
+        `True` if the file was written, `False` if the rows could not be located reliably
+    """
+
+    offsets = _find_segment_rows(data, residue_indices=residue_indices, chain_id=chain_id)
+    if offsets is None:
+        return False
+
+    loop_start, first, last, loop_end = offsets
+    with open(str(output_file), "wb", buffering=IO_BUFFER_SIZE) as fpo:
+        fpo.write(data[:loop_start])
+        fpo.write(data[first:last])
+        fpo.write(data[loop_end:])
+    return True
+
+
+# NOTE: Lines are anchored on the preceding line break (instead of `^`), which allows a fast literal search
+_ATOM_SITE_LOOP_RE = re.compile(rb"\nloop_[ \t]*\r?\n((?:[ \t]*_atom_site\.\S+[ \t]*\r?\n)+)")
+_LOOP_END_RE = re.compile(rb"\n[ \t]*(?:#|loop_|_|data_|save_)")
+
+
+def _find_segment_rows(
+    data: bytes | mmap.mmap,
+    *,
+    residue_indices: set[int],
+    chain_id: str,
+) -> tuple[int, int, int, int] | None:
+    """Locate the kept `_atom_site` rows in the raw bytes of a CIF file
+
+    Returns:
+        Byte offsets of the start of the `_atom_site` loop body, the start of
+        the first and the end of the last kept row, and the end of the loop body.
+        `None` if the rows could not be located reliably.
+    """
+
+    loop_match = _ATOM_SITE_LOOP_RE.search(data)
+    if loop_match is None:
+        return None
+
+    tags = [tag.lower() for tag in re.findall(rb"_atom_site\.(\S+)", loop_match[1])]
+    try:
+        asym_column = tags.index(b"label_asym_id")
+        seq_column = tags.index(b"label_seq_id")
+    except ValueError:
+        return None
+
+    loop_start = loop_match.end()
+    loop_end_match = _LOOP_END_RE.search(data, loop_start - 1)
+    loop_end = len(data) if loop_end_match is None else loop_end_match.start() + 1
+
+    # NOTE: Rows are matched by the position of whitespace-separated values,
+    #    which is unreliable for quoted values or multi-line text fields
+    if (data.find(b"\n;", loop_start, loop_end) != -1) or (data.find(b"'", loop_start, loop_end) != -1) or (
+        data.find(b'"', loop_start, loop_end) != -1
+    ):
+        return None
+
+    # NOTE: Only kept rows match, so that rows are filtered entirely by the regex engine
+    chain_pattern = re.escape(chain_id.encode())
+    seq_pattern = b"(?:" + b"|".join(str(i).encode() for i in residue_indices) + b")"
+    first_column, second_column = sorted([asym_column, seq_column])
+    first_pattern, second_pattern = (
+        (chain_pattern, seq_pattern) if asym_column < seq_column else (seq_pattern, chain_pattern)
+    )
+    row_pattern = re.compile(
+        rb"\n[ \t]*(?:\S+[ \t]+){%d}" % first_column
+        + first_pattern
+        + rb"[ \t]+(?:\S+[ \t]+){%d}" % (second_column - first_column - 1)
+        + second_pattern
+        + rb"(?=\s)"
+    )
+
+    first = last = None
+    for row_match in row_pattern.finditer(data, loop_start - 1, loop_end):
+        if first is None:
+            first = row_match.start() + 1
+        last = row_match.end()
+
+    if first is None:
+        return None
+
+    # NOTE: Include the line end of the last row
+    line_end = data.find(b"\n", last, loop_end)
+    last = loop_end if line_end == -1 else line_end + 1
+
+    return loop_start, first, last, loop_end
+
+
+def _extract_segment_from_cif_document(
+    doc: gemmi.cif.Document,
+    *,
+    residue_indices: set[int],
+    chain_id: str,
+) -> None:
+    """Remove `_atom_site` rows outside of the kept residue range from a parsed CIF document"""
+
     block = doc[0]
 
     table = block.find("_atom_site.", ["label_asym_id", "label_seq_id"])
 
-    # NOTE: Cannot iterate over table and delete rows at the same time
-    keep_rows = []
-    for row in table:
-        if (row[0] == chain_id) and (int(row[1]) in residue_indices):
-            keep_rows.append(row.row_index)
+    # NOTE: Filter rows in bulk instead of iterating over the table row by row.
+    #    Sequence IDs are only converted for rows of the requested chain.
+    asym_ids = np.array(list(block.find_values("_atom_site.label_asym_id")))
+    seq_ids = np.array(list(block.find_values("_atom_site.label_seq_id")))
+    keep = asym_ids == chain_id
+    keep[keep] = np.isin(seq_ids[keep].astype(np.int64), list(residue_indices))
+    keep_rows = np.flatnonzero(keep)
 
     n_rows = len(table)
-    start, end = min(keep_rows), max(keep_rows)
+    start, end = int(keep_rows[0]), int(keep_rows[-1])
     if start > 0:
         del table[:start]
     if end < n_rows - 1:
         # NOTE: Deleting rows shifts row indices, so subtract `start` from `end`
         del table[end - start + 1 :]
 
-    doc.write_file(str(output_file))
+
+# NOTE: Captures an ATOM entry without its last value, and the last value (the model number).
+#    Entries are anchored on the preceding line break, as ATOM entries are never on the first line.
+_ATOM_MODEL_NUM_RE = re.compile(rb"\n(ATOM[^\n]*[^ \t\n])[ \t]+(\d+)[ \t\r]*(?=\n|\Z)")
 
 
 def join_segments(
@@ -64,18 +210,41 @@ def join_segments(
         chain_id: Chain ID to filter residues from
     """
 
-    with open(str(output_file), "w") as fpo:
-        with open(str(input_files[0]), "r") as fpi:
-            for line in fpi:
-                fpo.write(line)
-
-            # NOTE: Assumes last line is last ATOM entry of last model
-            prev_model_count = int(line.split()[-1])
+    with open(str(output_file), "wb", buffering=IO_BUFFER_SIZE) as fpo:
+        with open(str(input_files[0]), "rb") as fpi:
+            shutil.copyfileobj(fpi, fpo, length=IO_BUFFER_SIZE)
+            prev_model_count = _read_last_model_number(fpi)
 
         for input_file in input_files[1:]:
-            with open(str(input_file), "r") as fpi:
-                for line in fpi:
-                    if line.startswith("ATOM"):
-                        model_count = int(line.split()[-1])
-                        fpo.write(" ".join(line.split()[:-1]) + f" {model_count + prev_model_count}\n")
-                prev_model_count = model_count + prev_model_count
+            with open(str(input_file), "rb") as fpi:
+                data = fpi.read()
+
+            model_count = 0
+            atom_lines = []
+            for match in _ATOM_MODEL_NUM_RE.finditer(data):
+                model_count = int(match[2])
+                atom_lines.append(b"%s %d\n" % (match[1], model_count + prev_model_count))
+            fpo.write(b"".join(atom_lines))
+            prev_model_count = model_count + prev_model_count
+
+
+def _read_last_model_number(fp: BinaryIO) -> int:
+    """Read the model number of the last ATOM entry in a CIF file, scanning backwards from the end"""
+
+    size = fp.seek(0, os.SEEK_END)
+    window = 4096
+    while True:
+        start = max(0, size - window)
+        fp.seek(start)
+
+        match = None
+        for match in _ATOM_MODEL_NUM_RE.finditer(fp.read()):
+            pass
+
+        if match is not None:
+            return int(match[2])
+
+        if start == 0:
+            raise ValueError(f"No ATOM entries found in {fp.name}")
+
+        window *= 2
@@ -1,8 +1,19 @@
+import dataclasses
+import functools
+import hashlib
+import json
+import mmap
+import os
+import re
 import shlex
 import subprocess
+import tempfile
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Any
 
+from loopbuilder import _cache
+from loopbuilder._io import prefetch
 from loopbuilder.segment import SegmentModel
 from loopbuilder.typing import StrPath
 
@@ -13,22 +24,30 @@ class SegmentModelEvaluatorBase:
     On init, the `parameters` dictionary will be populated with default parameters
     from (in that order):
         1. `SegmentModelEvaluatorBase.__default_parameters`
-        2. `<Subclass>.__default_parameters`
+        2. `<Subclass>.__default_parameters` of all subclasses (from base to derived class)
         3. User-provided keyword arguments
+
+    The default parameters are merged once per class when the class is created.
     """
 
     __default_parameters = {"cleanup": True}
+    _merged_default_parameters: dict[str, Any] = __default_parameters
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+
+        # NOTE: Mangled name of the private class attribute (leading underscores of the class name are stripped)
+        own_default_parameters = cls.__dict__.get(f"_{cls.__name__.lstrip('_')}__default_parameters", {})
+        cls._merged_default_parameters = {**cls._merged_default_parameters, **own_default_parameters}
 
     def __init__(self, identifier: str | None = None, **kwargs: Any):
         if identifier is None:
             identifier = self.__class__.__name__
         self.identifier = identifier
-
-        subclass_default_parameters = getattr(self, f"_{self.__class__.__name__}__default_parameters", {})
-        self.parameters = {**SegmentModelEvaluatorBase.__default_parameters, **subclass_default_parameters, **kwargs}
+        self.parameters = {**self._merged_default_parameters, **kwargs}
 
     def __repr__(self) -> str:
-        param_str = ", ".join(f"{k}={v}" for k, v in self.parameters.items())
+        param_str = ", ".join(["%s=%r" % item for item in self.parameters.items()])
         if param_str:
             param_str += ", "
         return f"{self.identifier}({param_str})"
@@ -44,6 +63,25 @@ class Scorer(ABC, SegmentModelEvaluatorBase):
         Compute arbitrary quantities for a model and store them in the model's `scores` dictionary.
         """
 
+    def score_batch(self, models: list[SegmentModel]) -> None:
+        """Score multiple models
+
+        Scores the models one by one by default. Scorers that benefit from processing
+        multiple models at once (e.g. by amortizing setup costs) should override this.
+        """
+
+        for model in models:
+            self.score(model)
+
+    def is_cacheable(self, scores: dict[str, Any]) -> bool:
+        """Decide if scores computed by this scorer may be cached (see `CachedScorer`)
+
+        By default, scores are not cached if any key ends with `"_error"` (e.g. `"molprobity_error"`),
+        so that failed runs are retried. Override to mark other results as not cacheable.
+        """
+
+        return not any(key.endswith("_error") for key in scores)
+
     def __call__(self, model: SegmentModel) -> None:
         self.score(model)
 
@@ -63,12 +101,184 @@ class Filter(ABC, SegmentModelEvaluatorBase):
         return self.filter(model)
 
 
+class CachedScorer(Scorer):
+    """Wrapper that caches the scores of another scorer on disk
+
+    Scores are stored in an SQLite database keyed on the SHA-256 hash of the model's
+    structure file, and the identifier and parameters of the wrapped scorer.
+    Scoring a model with an identical structure again (e.g. if PDBFixer converged
+    to the same conformation) becomes a lookup instead of a call to the wrapped scorer.
+    Only JSON-serializable scores are cached, and only if the wrapped scorer considers
+    them cacheable (see `Scorer.is_cacheable`).
+    """
+
+    __default_parameters = {
+        "cache_file": None,
+    }
+
+    def __init__(self, scorer: Scorer, identifier: str | None = None, **kwargs: Any):
+        super().__init__(identifier, **kwargs)
+        self.scorer = scorer
+        self._score_cache: _cache.ScoreCache | None = None
+
+    def __repr__(self) -> str:
+        return f"{self.identifier}({self.scorer!r})"
+
+    def cache_key(self, model: SegmentModel) -> str:
+        """Compute the cache key for a model"""
+
+        with open(model.structure_file, "rb") as fp:
+            structure_hash = hashlib.sha256(fp.read()).hexdigest()
+
+        scorer_str = json.dumps(
+            {"id": self.scorer.identifier, "params": self.scorer.parameters}, sort_keys=True, default=str
+        )
+        return structure_hash + scorer_str
+
+    def score(self, model: SegmentModel) -> None:
+        """Score a model using cached scores if available, otherwise using the wrapped scorer"""
+
+        self.score_batch([model])
+
+    def score_batch(self, models: list[SegmentModel]) -> None:
+        """Score models using cached scores if available, otherwise using the wrapped scorer
+
+        Models that are not in the cache are passed to the wrapped scorer in a single batch.
+        """
+
+        score_cache = self._score_cache = _cache.get_score_cache(self._score_cache, self.parameters["cache_file"])
+        keys = [self.cache_key(model) for model in models]
+        cached = score_cache.fetch_many(keys)
+
+        missed = []
+        for key, model in zip(keys, models):
+            scores = cached.get(key)
+            if scores is None:
+                missed.append((key, model))
+            else:
+                model.scores.update(scores)
+
+        if not missed:
+            return
+
+        # NOTE: The wrapped scorer starts from empty scores, so that all of its scores are cached
+        #    (even if a model already has them)
+        trial_models = [dataclasses.replace(model, scores={}) for _, model in missed]
+        self.scorer.score_batch(trial_models)
+
+        for (key, model), trial_model in zip(missed, trial_models):
+            scores = trial_model.scores
+            if self.scorer.is_cacheable(scores):
+                try:
+                    score_cache.store(key, scores)
+                except TypeError:
+                    # NOTE: Scores are not JSON-serializable and will not be cached
+                    pass
+
+            model.scores.update(scores)
+
+
+@dataclasses.dataclass(slots=True)
+class MolProbityScores:
+    """Scores read from a MolProbity output file (`None` if missing)"""
+
+    clashscore: float | None = None
+    ramachandran_outliers: float | None = None
+    rotamer_outliers: float | None = None
+    cbeta_deviations: float | None = None
+    rms_bonds: float | None = None
+    rms_angles: float | None = None
+    molprobity_score: float | None = None
+    # NOTE: Scores without a dedicated field (e.g. read by subclasses of `MolProbityScorer`)
+    extras: dict[str, float] = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, scores: dict[str, float]) -> "MolProbityScores":
+        """Create scores from a dictionary (e.g. as returned by `as_dict`)"""
+
+        extras = {k: v for k, v in scores.items() if k not in _MOLPROBITY_SCORE_FIELDS}
+        return cls(**{k: v for k, v in scores.items() if k in _MOLPROBITY_SCORE_FIELDS}, extras=extras)
+
+    def as_dict(self) -> dict[str, float]:
+        """Return all present scores as a dictionary (e.g. to update `SegmentModel.scores`)"""
+
+        scores = {name: value for name in _MOLPROBITY_SCORE_FIELDS if (value := getattr(self, name)) is not None}
+        scores.update(self.extras)
+        return scores
+
+
+_MOLPROBITY_SCORE_FIELDS = frozenset(f.name for f in dataclasses.fields(MolProbityScores) if f.name != "extras")
+
+
 class MolProbityScorer(Scorer):
-    """MolProbity-based loop scoring"""
+    """MolProbity-based loop scoring
+
+    MolProbity is run as an external program (optionally through Docker). Multiple models
+    are scored concurrently by `score_many` using a thread pool that is kept for the lifetime
+    of the scorer. Each model is processed in its own temporary output directory next to
+    its structure file, because MolProbity writes output files with fixed names into the
+    current working directory. The `"executable"` parameter is either a command line (split
+    like a shell would, e.g. `"phenix.molprobity --quiet"`) or a list of program arguments.
+
+    With the `"use_cache"` parameter, scores are cached in memory and in an SQLite database
+    (`"cache_file"`, see `CachedScorer`) keyed on a hash of the model's structure file.
+    Identical structures are then only scored once. Files that did not change (same path, size,
+    and modification time) are not hashed again.
+
+    Parsed scores are held in compact `MolProbityScores` objects (e.g. in the in-memory cache)
+    and are only converted to dictionaries when stored in a model's `scores`. The latter stays
+    a dictionary because it is shared with arbitrary other scorers and filters.
+    """
 
     __default_parameters = {
         "executable": "molprobity.molprobity",
+        "n_jobs": None,
+        "use_cache": False,
+        "cache_file": None,
+    }
+
+    # NOTE: Files MolProbity writes into the current working directory
+    _output_files = frozenset({"molprobity.out", "molprobity_probe.txt", "molprobity_coot.py"})
+
+    # NOTE: Patterns are anchored on line breaks instead of using `re.M` (see `loopbuilder.convert`)
+    # NOTE: Header line of the summary section in molprobity.out (e.g. "======= Summary =======")
+    _summary_section_re = re.compile(rb"(?:\A|\n)===\S*[ \t]+Summary\s")
+    # NOTE: Lines with exactly one "=" separating a key (without leading whitespace) and a value
+    _summary_line_re = re.compile(rb"\n[ \t]*([^=\n]*)=([^=\n]*)(?=\n|\Z)")
+
+    # NOTE: Key in molprobity.out -> (used key, value is a percentage to convert to a rate)
+    _score_keys: dict[bytes, tuple[str, bool]] = {
+        b"Clashscore": ("clashscore", False),
+        b"Ramachandran outliers": ("ramachandran_outliers", True),
+        b"Rotamer outliers": ("rotamer_outliers", True),
+        b"C-beta deviations": ("cbeta_deviations", False),
+        b"RMS(bonds)": ("rms_bonds", False),
+        b"RMS(angles)": ("rms_angles", False),
+        b"MolProbity score": ("molprobity_score", False),
     }
+    # NOTE: First bytes of all keys to quickly reject most lines without a dictionary lookup
+    _first_bytes = frozenset(key[0] for key in _score_keys)
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+
+        # NOTE: Subclasses may extend the score keys
+        cls._first_bytes = frozenset(key[0] for key in cls._score_keys)
+
+    def __init__(self, identifier: str | None = None, **kwargs: Any):
+        super().__init__(identifier, **kwargs)
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_size = 0
+        self._cache: dict[str, MolProbityScores] = {}
+        self._fast_cache: dict[tuple[str, int, int, str, str | None], str] = {}
+        self._score_cache: _cache.ScoreCache | None = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        # NOTE: Thread pools can not be pickled (e.g. when sending the scorer to worker processes)
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_pool_size"] = 0
+        return state
 
     def score(self, model: SegmentModel) -> None:
         """Score a model using MolProbity
@@ -88,73 +298,266 @@ class MolProbityScorer(Scorer):
         under the key `"molprobity_error"`.
         """
 
-        exe = self.parameters["executable"]
+        self.score_many([model], max_workers=1)
+
+    def score_batch(self, models: list[SegmentModel]) -> None:
+        """Score multiple models concurrently using MolProbity (see `score_many`)"""
+
+        self.score_many(models)
+
+    def score_many(self, models: list[SegmentModel], max_workers: int | None = None) -> None:
+        """Score multiple models concurrently using MolProbity
+
+        See `score` for the computed scores.
+
+        Args:
+            models: List of `SegmentModel` objects to score
+
+        Keyword args:
+            max_workers: Maximum number of concurrent MolProbity processes. If `None`, uses the
+                `"n_jobs"` parameter or `os.cpu_count()` if that is `None` as well.
+        """
+
+        # NOTE: Parameters are looked up once per call instead of once per model
+        parameters = self.parameters
+        executable = parameters["executable"]
+        if isinstance(executable, str):
+            # NOTE: Tokenized once per call (e.g. for "python /path/to/molprobity.py")
+            executable = shlex.split(executable)
+        use_cache = parameters.get("use_cache", False)
+        cache_file = parameters.get("cache_file")
+        cleanup = parameters.get("cleanup", False)
+        if max_workers is None:
+            max_workers = parameters.get("n_jobs") or os.cpu_count() or 1
+
+        run = functools.partial(self._run, executable=executable, docker_image=parameters.get("docker_image"))
+
+        # NOTE: Models with identical structures are grouped, so that MolProbity runs only once for them
+        if use_cache:
+            keyed_models = []
+            uncached_models = []
+            for model in models:
+                try:
+                    keyed_models.append((self._fast_cache_key(model), model))
+                except OSError:
+                    # NOTE: E.g. missing structure files are handled (and reported) like without cache
+                    uncached_models.append(model)
+            cached = self._fetch_many([key for key, _ in keyed_models], cache_file)
+
+            groups: dict[str, list[SegmentModel]] = {}
+            for key, model in keyed_models:
+                cached_scores = cached.get(key)
+                if cached_scores is None:
+                    groups.setdefault(key, []).append(model)
+                else:
+                    model.scores.update(cached_scores.as_dict())
+            keys = [*groups, *[None] * len(uncached_models)]
+            model_groups = [*groups.values(), *[[model] for model in uncached_models]]
+        else:
+            keys = [None] * len(models)
+            model_groups = [[model] for model in models]
+
+        run_models = [group[0] for group in model_groups]
+        output_directories: list[str] = []
+        futures = []
+        try:
+            for model in run_models:
+                output_directories.append(self._make_output_directory(model))
+
+            if max_workers == 1 or len(run_models) <= 1:
+                results = [run(model, d) for model, d in zip(run_models, output_directories)]
+            else:
+                pool = self._get_pool(max_workers)
+                futures = [pool.submit(run, model, d) for model, d in zip(run_models, output_directories)]
+                results = [future.result() for future in futures]
+
+            # NOTE: Output files of successful runs are read and parsed concurrently
+            output_files = [
+                os.path.join(output_directory, "molprobity.out")
+                for result, output_directory in zip(results, output_directories)
+                if result.returncode == 0
+            ]
+            if max_workers == 1 or len(output_files) <= 1:
+                outputs = map(self._parse_one, output_files)
+            else:
+                outputs = self._get_pool(max_workers).map(self._parse_one, output_files)
+
+            for key, group, result in zip(keys, model_groups, results):
+                if result.returncode != 0:
+                    scores = {"molprobity_error": result.stderr.decode("utf-8", errors="replace")}
+                else:
+                    parsed_scores = next(outputs)
+                    if key is not None:
+                        self._store(key, parsed_scores, cache_file)
+                    scores = parsed_scores.as_dict()
+
+                for model in group:
+                    model.scores.update(scores)
+        finally:
+            # NOTE: If a run raised, wait for the others before removing their output directories
+            wait(futures)
+            if cleanup:
+                for output_directory in output_directories:
+                    self._cleanup(output_directory)
+
+    def cache_key(self, model: SegmentModel) -> str:
+        """Compute the cache key for a model
+
+        The key combines a hash of the model's structure file with the MolProbity executable
+        (and Docker image) used for scoring.
+        """
+
+        with open(model.structure_file, "rb") as fp:
+            structure_hash = hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+
+        return (
+            f"{self.__class__.__name__}:{self.parameters['executable']}:"
+            f"{self.parameters.get('docker_image')}:{structure_hash}"
+        )
+
+    def _fast_cache_key(self, model: SegmentModel) -> str:
+        """Compute the cache key for a model, avoiding to hash unchanged files again
+
+        Keys are remembered by path, size, and modification time of the structure file.
+        """
+
+        stat = os.stat(model.structure_file)
+        file_key = (
+            str(model.structure_file), stat.st_size, stat.st_mtime_ns,
+            repr(self.parameters["executable"]), self.parameters.get("docker_image"),
+        )
+        key = self._fast_cache.get(file_key)
+        if key is None:
+            key = self._fast_cache[file_key] = self.cache_key(model)
+        return key
+
+    def _fetch_many(self, keys: list[str], cache_file: StrPath | None) -> dict[str, MolProbityScores]:
+        """Look up cached scores in memory and then (for all missing keys at once) on disk"""
+
+        found = {key: self._cache[key] for key in keys if key in self._cache}
+        missing = [key for key in keys if key not in found]
+        if missing:
+            self._score_cache = _cache.get_score_cache(self._score_cache, cache_file)
+            for key, scores in self._score_cache.fetch_many(missing).items():
+                found[key] = self._cache[key] = MolProbityScores.from_dict(scores)
+        return found
+
+    def _store(self, key: str, scores: MolProbityScores, cache_file: StrPath | None) -> None:
+        """Store scores in memory and on disk"""
+
+        self._cache[key] = scores
+        self._score_cache = _cache.get_score_cache(self._score_cache, cache_file)
+        self._score_cache.store(key, scores.as_dict())
+
+    def _get_pool(self, max_workers: int) -> ThreadPoolExecutor:
+        """Return the (lazily created) thread pool of the scorer"""
+
+        if self._pool is None or self._pool_size != max_workers:
+            if self._pool is not None:
+                self._pool.shutdown()
+            # NOTE: Threads are sufficient because the work is done in external processes
+            self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="molprobity")
+            self._pool_size = max_workers
+        return self._pool
+
+    @staticmethod
+    def _make_output_directory(model: SegmentModel) -> str:
+        """Create a new output directory for a model next to its structure file"""
+
+        structure_dir, structure_name = os.path.split(os.fspath(model.structure_file))
+        prefix = f"{os.path.splitext(structure_name)[0]}_molprobity_"
+        return tempfile.mkdtemp(prefix=prefix, dir=structure_dir or os.curdir)
+
+    def _run(
+        self, model: SegmentModel, output_directory: str, *, executable: list[str], docker_image: str | None
+    ) -> subprocess.CompletedProcess:
+        """Run MolProbity for a single model in the given output directory"""
+
+        # NOTE: Plain string operations instead of creating multiple intermediate `Path` objects
+        structure_dir, structure_name = os.path.split(os.fspath(model.structure_file))
+        structure_dir = structure_dir or os.curdir
 
         # NOTE: This is a bit of a hack to optionally run MolProbity through a Docker container
-        # NOTE: MolProbity writes its main output file (molprobity.out) to the current working directory
-        docker_image = self.parameters.get("docker_image")
         if docker_image is not None:
-            structure_dir = str(model.structure_file.parent).replace('\\', '/')
-            cmd = f"docker run -v {structure_dir}:/data -w /data {docker_image} {exe} {model.structure_file.name}"
+            # NOTE: The user in the container may differ from the owner of the output directory
+            os.chmod(output_directory, 0o777)
+            mount_dir = structure_dir.replace("\\", "/")
+            cmd = [
+                "docker", "run", "--rm",
+                "-v", f"{mount_dir}:/data",
+                "-w", f"/data/{os.path.basename(output_directory)}",
+                docker_image, *executable, f"../{structure_name}",
+            ]
             cwd = None
         else:
-            cmd = f"{exe} {model.structure_file.name}"
-            cwd = model.structure_file.parent
+            cmd = [*executable, f"../{structure_name}"]
+            cwd = output_directory
+
+        # NOTE: Only stderr is used (on errors), so stdout is discarded and nothing is decoded here
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=cwd)
+        if result.returncode == 0:
+            # NOTE: Start reading the output in the background while other runs finish
+            prefetch(os.path.join(output_directory, "molprobity.out"))
+        return result
+
+    def _cleanup(self, output_directory: str) -> None:
+        """Remove MolProbity output files and the output directory"""
+
+        # NOTE: A single directory scan instead of trying to remove each possible file
+        with os.scandir(output_directory) as entries:
+            for entry in entries:
+                if entry.name in self._output_files:
+                    os.unlink(entry.path)
+
+        try:
+            os.rmdir(output_directory)
+        except OSError:
+            # NOTE: Keep the directory if MolProbity wrote unexpected files
+            pass
 
-        result = subprocess.run(shlex.split(cmd), capture_output=True, encoding="utf-8", cwd=cwd)
+    def parse_output(self, output_file: StrPath) -> dict[str, Any]:
+        """Parse the output of MolProbity and extract scores"""
 
-        if result.returncode != 0:
-            model.scores["molprobity_error"] = result.stderr
-            return
+        return self._parse_one(output_file).as_dict()
 
-        output_file = model.structure_file.with_name("molprobity.out")
-        scores = self.parse_output(output_file)
-        model.scores.update(scores)
-        
-        if self.parameters.get("cleanup", False):
-            output_file.unlink(missing_ok=True)
-            output_file.with_name("molprobity_probe.txt").unlink(missing_ok=True)
-            output_file.with_name("molprobity_coot.py").unlink(missing_ok=True)
+    def _parse_one(self, output_file: StrPath) -> MolProbityScores:
+        """Read and parse a MolProbity output file"""
 
-    def parse_output(self, output_file: StrPath) -> dict[str, Any]:
-        """Parse the output of MolProbity and extract scores"""
+        with open(output_file, "rb") as fp:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # NOTE: Empty files can not be mapped
+                return MolProbityScores()
 
-        score_key_map = {
-            # Key in molprobity.out, used key, converter
-            "Clashscore": ("clashscore", float),
-            "Ramachandran outliers": ("ramachandran_outliers", lambda x: round(float(x.strip(" %")) / 100, 4)),
-            "Rotamer outliers": ("rotamer_outliers", lambda x: round(float(x.strip(" %")) / 100, 4)),
-            "C-beta deviations": ("cbeta_deviations", float),
-            "RMS(bonds)": ("rms_bonds", float),
-            "RMS(angles)": ("rms_angles", float),
-            "MolProbity score": ("molprobity_score", float),
-        }
-
-        scores = {}
-        with open(output_file, "r") as fp:
-            # Find summary section
-            for line in fp:
-                if not line.startswith("==="):
-                    continue
+        with data:
+            return self._parse_scores(data)
 
-                try:
-                    section = line.split()[1]
-                except IndexError:
-                    continue
+    def _parse_scores(self, data: bytes | mmap.mmap) -> MolProbityScores:
+        """Extract scores from the content of a MolProbity output file"""
 
-                if section == "Summary":
-                    break
+        score_keys = self._score_keys
+        first_bytes = self._first_bytes
 
-            for line in fp:
-                try:
-                    key, value = line.split("=")
-                except ValueError:
-                    continue
+        scores = MolProbityScores()
+        section = self._summary_section_re.search(data)
+        if section is None:
+            return scores
 
-                try:
-                    key_, convert = score_key_map[key.strip()]
-                except KeyError:
-                    continue
+        for match in self._summary_line_re.finditer(data, section.end() - 1):
+            key = match[1]
+            if not key or key[0] not in first_bytes:
+                continue
+
+            try:
+                score_key, is_percent = score_keys[key.rstrip()]
+            except KeyError:
+                continue
 
-                scores[key_] = convert(value.strip())
+            raw_value = match[2].strip()
+            value = round(float(raw_value.rstrip(b" %")) / 100, 4) if is_percent else float(raw_value)
+            if score_key in _MOLPROBITY_SCORE_FIELDS:
+                setattr(scores, score_key, value)
+            else:
+                scores.extras[score_key] = value
         return scores
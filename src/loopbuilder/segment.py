@@ -1,17 +1,21 @@
 import pathlib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 
 
-@dataclass
+@dataclass(slots=True)
 class SegmentModel:
     identifier: str
     structure_file: pathlib.Path
     scores: dict[str, Any]
     index: int = 0
+    # NOTE: Optional in-memory content of `structure_file` (not yet written to disk)
+    structure_data: bytes | None = field(default=None, repr=False)
+    # NOTE: Optional hash of the segment structure, used to recognize identical trial models
+    structure_hash: str | None = field(default=None, repr=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class Segment:
     identifier: str
     chain_index: int
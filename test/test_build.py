@@ -0,0 +1,165 @@
+import csv
+
+import gemmi
+import pytest
+
+from loopbuilder.build import Builder
+from loopbuilder.score import Filter, Scorer
+from loopbuilder.segment import Segment, SegmentModel
+
+
+class FakeBuilder(Builder):
+    """Builder that returns the input structure as every trial model
+
+    Defined at module level so that it can be sent to worker processes.
+    """
+
+    def build_segment(self, segment, trial_id, working_directory):
+        stem = f"{segment.parent_structure_file.stem}_{segment.identifier}_{trial_id}"
+        return SegmentModel(
+            identifier=segment.identifier,
+            structure_file=working_directory / f"{stem}.cif",
+            scores={},
+            structure_data=segment.parent_structure_file.read_bytes(),
+        )
+
+
+class SizeScorer(Scorer):
+    def score(self, model):
+        model.scores["size"] = model.structure_file.stat().st_size
+
+
+class TrialScorer(Scorer):
+    def score(self, model):
+        model.scores["trial"] = int(model.structure_file.stem.split("_")[-2])
+
+
+class EveryOtherFilter(Filter):
+    """Stateful filter that rejects every other model"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_calls = 0
+
+    def filter(self, model):
+        self.n_calls += 1
+        return self.n_calls % 2 == 0
+
+
+@pytest.fixture
+def structure_file(tmp_path, data_dir):
+    """Input structure with the atom site loop as the last category (like structures written by PDBFixer)"""
+
+    data = (data_dir / "3idp.cif").read_text()
+    start = data.index("loop_\n_atom_site.")
+    end = data.index("\n#", start)
+    structure_file = tmp_path / "3idp.cif"
+    structure_file.write_text(f"data_3IDP\n#\n{data[start:end]}\n")
+    return structure_file
+
+
+def make_segments(structure_file, n_segments):
+    segments = [
+        Segment("loop_A", 0, "A", 8, 30, 22, ["ALA"] * 11, structure_file, []),
+        Segment("loop_B", 1, "B", 38, 60, 22, ["ALA"] * 11, structure_file, []),
+    ]
+    return segments[:n_segments]
+
+
+@pytest.mark.parametrize(
+    "kwargs,n_segments",
+    [
+        ({}, 1),
+        ({}, 2),
+        ({"n_jobs": 2}, 1),
+        ({"n_jobs": 2}, 2),
+        ({"pipeline": True}, 1),
+        ({"batch_size": 3}, 2),
+        ({"n_jobs": 2, "batch_size": 2}, 1),
+        ({"parallel_scoring": True}, 1),
+        ({"n_jobs": 2, "parallel_scoring": True, "batch_size": 2}, 2),
+    ],
+)
+def test_build(tmp_path, structure_file, kwargs, n_segments):
+    output_directory = tmp_path / "output"
+    builder = FakeBuilder(
+        structure_file,
+        output_directory,
+        working_directory=tmp_path / "work",
+        scorers=[SizeScorer(), TrialScorer()],
+        filters=[EveryOtherFilter()],
+        progress_bar=False,
+        **kwargs,
+    )
+    builder.segments = make_segments(builder.structure_file, n_segments)
+
+    segments = builder.build(3, max_tries=10)
+
+    assert [s.identifier for s in segments] == ["loop_A", "loop_B"][:n_segments]
+    for segment in segments:
+        assert [m.index for m in segment.models] == [1, 2, 3]
+
+        joined_file = output_directory / f"3idp_{segment.identifier}.cif"
+        for model in segment.models:
+            assert model.structure_file == joined_file
+            assert model.scores["size"] > 0
+            assert 1 <= model.scores["trial"] <= 10
+
+        # All models are joined into a single file with one model number per model
+        block = gemmi.cif.read(str(joined_file)).sole_block()
+        model_numbers = {int(n) for n in block.find_values("_atom_site.pdbx_PDB_model_num")}
+        assert model_numbers == {1, 2, 3}
+        seq_ids = {int(n) for n in block.find_values("_atom_site.label_seq_id")}
+        assert min(seq_ids) == segment.residue_start_seqid
+        assert max(seq_ids) == segment.residue_start_seqid + len(segment) - 1
+
+    # Only joined files remain in the output directory
+    assert sorted(p.name for p in output_directory.glob("*.cif")) == [
+        f"3idp_{s.identifier}.cif" for s in segments
+    ]
+
+    with open(output_directory / "models.csv") as fp:
+        rows = list(csv.DictReader(fp))
+    assert [(row["identifier"], row["index"]) for row in rows] == [
+        (s.identifier, str(i)) for s in segments for i in (1, 2, 3)
+    ]
+
+
+def test_build_max_tries(tmp_path, structure_file):
+    builder = FakeBuilder(
+        structure_file,
+        tmp_path / "output",
+        working_directory=tmp_path / "work",
+        filters=[EveryOtherFilter()],
+        progress_bar=False,
+    )
+    builder.segments = make_segments(builder.structure_file, 1)
+
+    (segment,) = builder.build(3, max_tries=3)
+    assert [m.index for m in segment.models] == [1]
+
+
+@pytest.mark.parametrize("trial_cache", [False, True])
+def test_build_trial_cache(tmp_path, structure_file, trial_cache):
+    # All trial models are identical, so with the trial cache the result of the first one is reused
+    builder = FakeBuilder(
+        structure_file,
+        tmp_path / "output",
+        working_directory=tmp_path / "work",
+        scorers=[SizeScorer()],
+        filters=[EveryOtherFilter()],
+        progress_bar=False,
+        trial_cache=trial_cache,
+    )
+    builder.segments = make_segments(builder.structure_file, 1)
+
+    (segment,) = builder.build(2, max_tries=6)
+    if trial_cache:
+        assert segment.models == []
+        assert builder.filters[0].n_calls == 1
+    else:
+        assert [m.index for m in segment.models] == [1, 2]
+        assert builder.filters[0].n_calls == 4
+
+    with open(tmp_path / "output" / "models.csv") as fp:
+        assert len(list(csv.DictReader(fp))) == len(segment.models)
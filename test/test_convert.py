@@ -2,9 +2,11 @@ import pathlib
 import shutil
 import tempfile
 
+import gemmi
 import mdtraj
+import pytest
 
-from loopbuilder.convert import join_segments
+from loopbuilder.convert import _extract_segment_from_cif_document, extract_segment_from_mmcif, join_segments
 
 
 SEGMENT_MODEL_1 = """
@@ -119,4 +121,37 @@ def test_join_segments():
     assert traj.n_frames == 2
     assert traj.n_atoms == 9
 
-    shutil.rmtree(tmpdir, ignore_errors=True)
\ No newline at end of file
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+@pytest.mark.parametrize(
+    "structure,chain_id,residue_indices",
+    [
+        ("3idp", "B", {30, 40}),
+        ("6x18", "A", {60, 70}),
+        ("8rx0", "E", {100, 140}),
+    ],
+)
+def test_extract_segment_from_mmcif(data_dir, structure, chain_id, residue_indices):
+    tmpdir = tempfile.mkdtemp(dir=".")
+    tmpdir = pathlib.Path(tmpdir)
+    input_file = data_dir / f"{structure}.cif"
+    output_file = tmpdir / "segment.cif"
+
+    extract_segment_from_mmcif(input_file, output_file, residue_indices=residue_indices, chain_id=chain_id)
+
+    expected_doc = gemmi.cif.read(str(input_file))
+    _extract_segment_from_cif_document(expected_doc, residue_indices=residue_indices, chain_id=chain_id)
+    expected_block = expected_doc[0]
+    block = gemmi.cif.read(str(output_file))[0]
+
+    assert [str(name) for name in block.get_mmcif_category_names()] == [
+        str(name) for name in expected_block.get_mmcif_category_names()
+    ]
+
+    table = block.find_mmcif_category("_atom_site.")
+    expected_table = expected_block.find_mmcif_category("_atom_site.")
+    assert len(table) > 0
+    assert [list(row) for row in table] == [list(row) for row in expected_table]
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
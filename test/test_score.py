@@ -0,0 +1,234 @@
+import pickle
+import sys
+
+import pytest
+
+from loopbuilder.score import CachedScorer, MolProbityScorer, MolProbityScores, Scorer
+from loopbuilder.segment import SegmentModel
+
+
+class CountingScorer(Scorer):
+    __default_parameters = {"offset": 1}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_calls = 0
+
+    def score(self, model):
+        self.n_calls += 1
+        model.scores["count"] = self.n_calls + self.parameters["offset"]
+
+
+def test_cached_scorer(tmp_path):
+    structure_file = tmp_path / "model.cif"
+    structure_file.write_text("data_model\n")
+    cache_file = tmp_path / "scores.db"
+
+    inner = CountingScorer()
+    scorer = CachedScorer(inner, cache_file=cache_file)
+
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={"other": 0})
+    scorer(model)
+    assert model.scores == {"other": 0, "count": 2}
+
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+    scorer(model)
+    assert model.scores == {"count": 2}
+    assert inner.n_calls == 1
+
+    # Different parameters of the wrapped scorer invalidate the cache
+    scorer = CachedScorer(CountingScorer(offset=2), cache_file=cache_file)
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+    scorer(model)
+    assert model.scores == {"count": 3}
+
+
+class SizeScorer(Scorer):
+    def score(self, model):
+        model.scores["size"] = model.structure_file.stat().st_size
+
+
+def test_cached_scorer_rescore(tmp_path):
+    structure_file = tmp_path / "model.cif"
+    structure_file.write_text("data_model\n")
+
+    inner = SizeScorer()
+    scorer = CachedScorer(inner, cache_file=tmp_path / "scores.db")
+
+    # Rescoring a model that already has the scores still caches all of them
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+    inner(model)
+    scorer(model)
+    assert model.scores == {"size": 11}
+
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+    scorer(model)
+    assert model.scores == {"size": 11}
+
+
+class FailingScorer(Scorer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_calls = 0
+
+    def score(self, model):
+        self.n_calls += 1
+        model.scores["failing_error"] = "failed"
+
+
+def test_cached_scorer_errors(tmp_path):
+    structure_file = tmp_path / "model.cif"
+    structure_file.write_text("data_model\n")
+
+    inner = FailingScorer()
+    scorer = CachedScorer(inner, cache_file=tmp_path / "scores.db")
+
+    # Failed runs are not cached
+    for _ in range(2):
+        model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+        scorer(model)
+        assert model.scores == {"failing_error": "failed"}
+    assert inner.n_calls == 2
+
+    # The database connection is not pickled
+    assert pickle.loads(pickle.dumps(scorer))._score_cache._connection is None
+
+
+MOLPROBITY_OUTPUT = """\
+================================== Summary ===================================
+
+  Ramachandran outliers =   1.50 %
+                favored =  97.50 %
+  Rotamer outliers      =   2.00 %
+  C-beta deviations     =     1
+  Clashscore            =   3.45
+  RMS(bonds)            =   0.0070
+  RMS(angles)           =   0.89
+  MolProbity score      =   1.45
+"""
+
+
+@pytest.fixture
+def molprobity_executable(tmp_path):
+    """Fake MolProbity executable that writes a fixed summary into the working directory"""
+
+    executable = tmp_path / "molprobity"
+    executable.write_text(
+        f"#!{sys.executable}\n"
+        "import pathlib, sys\n"
+        "if not pathlib.Path(sys.argv[1]).is_file():\n"
+        "    sys.exit('missing structure file')\n"
+        f"with open({str(tmp_path / 'calls')!r}, 'a') as fp:\n"
+        "    fp.write(sys.argv[1] + '\\n')\n"
+        "for name in ('molprobity_probe.txt', 'molprobity_coot.py'):\n"
+        "    pathlib.Path(name).touch()\n"
+        f"pathlib.Path('molprobity.out').write_text({MOLPROBITY_OUTPUT!r})\n"
+    )
+    executable.chmod(0o755)
+    return executable
+
+
+def test_molprobity_scorer(tmp_path, molprobity_executable):
+    models = []
+    for i in range(3):
+        structure_file = tmp_path / f"model_{i}.cif"
+        structure_file.write_text("data_model\n")
+        models.append(SegmentModel(identifier="loop_1", structure_file=structure_file, scores={}))
+    models.append(SegmentModel(identifier="loop_1", structure_file=tmp_path / "missing.cif", scores={}))
+
+    scorer = MolProbityScorer(executable=str(molprobity_executable), n_jobs=2)
+    scorer.score_many(models)
+
+    for model in models[:-1]:
+        assert model.scores == {
+            "ramachandran_outliers": 0.015,
+            "rotamer_outliers": 0.02,
+            "cbeta_deviations": 1.0,
+            "clashscore": 3.45,
+            "rms_bonds": 0.007,
+            "rms_angles": 0.89,
+            "molprobity_score": 1.45,
+        }
+    assert "missing structure file" in models[-1].scores["molprobity_error"]
+
+    # Output directories are removed on cleanup
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        ["molprobity", "calls", "model_0.cif", "model_1.cif", "model_2.cif"]
+    )
+
+    # The thread pool is not pickled along with the scorer
+    assert pickle.loads(pickle.dumps(scorer))._pool is None
+
+
+def test_molprobity_scorer_cache(tmp_path, molprobity_executable):
+    models = []
+    for i, content in enumerate(["data_a\n", "data_a\n", "data_b\n"]):
+        structure_file = tmp_path / f"model_{i}.cif"
+        structure_file.write_text(content)
+        models.append(SegmentModel(identifier="loop_1", structure_file=structure_file, scores={}))
+
+    cache_file = tmp_path / "scores.db"
+    scorer = MolProbityScorer(executable=str(molprobity_executable), use_cache=True, cache_file=cache_file)
+    scorer.score_many(models)
+
+    # Identical structures are only scored once
+    assert len((tmp_path / "calls").read_text().splitlines()) == 2
+    assert all(model.scores["molprobity_score"] == 1.45 for model in models)
+
+    # Missing files are reported like without cache
+    missing_model = SegmentModel(identifier="loop_1", structure_file=tmp_path / "missing.cif", scores={})
+    scorer.score_many([missing_model])
+    assert "missing structure file" in missing_model.scores["molprobity_error"]
+
+    # Changed files are scored again
+    models[2].structure_file.write_text("data_changed\n")
+    scorer.score_many(models)
+    assert len((tmp_path / "calls").read_text().splitlines()) == 3
+
+    # Scores are persisted on disk
+    scorer = MolProbityScorer(executable=str(molprobity_executable), use_cache=True, cache_file=cache_file)
+    model = SegmentModel(identifier="loop_1", structure_file=models[0].structure_file, scores={})
+    scorer.score(model)
+    assert len((tmp_path / "calls").read_text().splitlines()) == 3
+    assert model.scores == models[0].scores
+
+
+def test_default_parameters():
+    class SubScorer(CountingScorer):
+        __default_parameters = {"scale": 2}
+
+    assert CountingScorer().parameters == {"cleanup": True, "offset": 1}
+    assert SubScorer(offset=3).parameters == {"cleanup": True, "offset": 3, "scale": 2}
+    assert MolProbityScorer().parameters["executable"] == "molprobity.molprobity"
+
+
+def test_molprobity_scores():
+    scores = MolProbityScores.from_dict({"clashscore": 3.45, "other": 1.0})
+    assert scores.clashscore == 3.45
+    assert scores.molprobity_score is None
+    assert scores.extras == {"other": 1.0}
+    assert scores.as_dict() == {"clashscore": 3.45, "other": 1.0}
+
+
+def test_molprobity_scorer_command_line(tmp_path, molprobity_executable):
+    structure_file = tmp_path / "model.cif"
+    structure_file.write_text("data_model\n")
+    model = SegmentModel(identifier="loop_1", structure_file=structure_file, scores={})
+
+    scorer = MolProbityScorer(executable=f"{sys.executable} {molprobity_executable}")
+    scorer.score(model)
+    assert model.scores["molprobity_score"] == 1.45
+
+
+def test_molprobity_scorer_cleanup_on_exception(tmp_path):
+    models = []
+    for i in range(3):
+        structure_file = tmp_path / f"model_{i}.cif"
+        structure_file.write_text("data_model\n")
+        models.append(SegmentModel(identifier="loop_1", structure_file=structure_file, scores={}))
+
+    scorer = MolProbityScorer(executable=str(tmp_path / "missing"), n_jobs=2)
+    with pytest.raises(FileNotFoundError):
+        scorer.score_many(models)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["model_0.cif", "model_1.cif", "model_2.cif"]